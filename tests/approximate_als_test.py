@@ -62,6 +62,10 @@ try:
         class FaissALSGPUTest(unittest.TestCase, RecommenderBaseTestMixin):
             __regularization = 0
 
+            # test_similar_items changes __regularization and needs _get_model
+            # re-invoked for its fit, so reusing fitted models isn't safe here
+            cache_fitted_models = False
+
             def _get_model(self):
                 return FaissAlternatingLeastSquares(
                     nlist=1,